@@ -1,64 +1,127 @@
-import random
+import math
+import os
+import queue
+import subprocess
+import tempfile
+import threading
+from fractions import Fraction
 import numpy as np
-from moviepy.editor import ImageClip, concatenate_videoclips
-from moviepy.audio.AudioClip import AudioArrayClip
+from moviepy.config import get_setting
+from numba import njit
 from PIL import Image, ImageDraw, ImageFont
 
 # --- Configuration Parameters ---      
 SAMPLE_RATE = 96000     # Audio sample rate in Hz
+SINE_LUT_BITS = 12      # 4096-entry sine lookup table
+
+# Shared random generator for rectangle placement and tone frequencies
+rng = np.random.default_rng()
+
+# One full period of a full-scale 16-bit sine wave, looked up by the tone generator instead of calling np.sin
+SINE_LUT = (32767 * np.sin(2 * np.pi * np.arange(1 << SINE_LUT_BITS) / (1 << SINE_LUT_BITS))).astype(np.float32)
+# The top SINE_LUT_BITS of a 32-bit phase accumulator select the table entry
+PHASE_SHIFT = np.uint32(32 - SINE_LUT_BITS)
+
+def render_text(text, font_obj):
+    # Render monochrome text to a boolean glyph mask, sized to its advance width and the font's line height
+    ascent, descent = font_obj.getmetrics()
+    image = Image.new("L", (max(math.ceil(font_obj.getlength(text)), 1), ascent + descent), 0)
+    ImageDraw.Draw(image).text((0, 0), text, fill=255, font=font_obj)
+    return np.asarray(image) > 127
+
+def compose_label(label, slide_number):
+    # Lay the cached prefix and digit masks out into one mask for this slide's label
+    digits = f"{slide_number:04d}"
+    digit_xs = [round(label["prefix_advance"] + position * label["digit_advance"]) for position in range(len(digits))]
+    prefix = label["prefix"]
+    mask_width = max(prefix.shape[1], digit_xs[-1] + label["digits"][int(digits[-1])].shape[1])
+    text_mask = np.zeros((prefix.shape[0], mask_width), np.bool_)
+    text_mask[:, :prefix.shape[1]] = prefix
+    for digit_x, digit in zip(digit_xs, digits):
+        digit_mask = label["digits"][int(digit)]
+        text_mask[:, digit_x:digit_x + digit_mask.shape[1]] |= digit_mask
+    return text_mask
+
+def prerender_label(font_obj, file_name="aqua.flv"):
+    # Only the four digits of "aqua.flv - slide XXXX" change between slides, so the
+    # prefix and the ten digit glyphs are rendered once and composed per slide
+    prefix = f"{file_name} - slide "
+    return {
+        "prefix": render_text(prefix, font_obj),
+        "prefix_advance": font_obj.getlength(prefix),
+        "digits": [render_text(str(digit), font_obj) for digit in range(10)],
+        # Digits are laid out on a fixed advance, as the figures of most fonts are tabular
+        "digit_advance": font_obj.getlength("0"),
+        # Measured once on a representative label, as every slide's label has the same extent
+        "bbox": font_obj.getbbox(f"{prefix}0000"),
+    }
+
+@njit(boundscheck=False, cache=True)
+def fill_slide(canvas, blue_x, blue_y, blue_width, blue_height, red_x, red_y, red_width, red_height, text_mask, text_x, text_y):
+    # Draw a whole slide row by row: clear to white, fill the blue and then the red (always on top)
+    # rectangle, and blacken the label's glyph pixels, all clipped to the canvas
+    height, width, _ = canvas.shape
+    mask_height, mask_width = text_mask.shape
+    text_width = max(min(mask_width, width - text_x), 0)
+    for y in range(height):
+        row = canvas[y]
+        row[:] = 255
+        if blue_y <= y < blue_y + blue_height:
+            row[blue_x:blue_x + blue_width, 0] = 0
+            row[blue_x:blue_x + blue_width, 1] = 0
+            row[blue_x:blue_x + blue_width, 2] = 255
+        if red_y <= y < red_y + red_height:
+            row[red_x:red_x + red_width, 0] = 255
+            row[red_x:red_x + red_width, 1] = 0
+            row[red_x:red_x + red_width, 2] = 0
+        if text_y <= y < text_y + mask_height:
+            glyph_row = text_mask[y - text_y, :text_width]
+            for channel in range(3):
+                pixels = row[text_x:text_x + text_width, channel]
+                pixels[glyph_row] = 0
+
+def generate_slide(canvas, slide_number, label):
+    height, width, _ = canvas.shape
+
+    # --- Pick the Blue and Red (Always on top) Rectangles ---
+    # All eight parameters come from two generator calls rather than eight separate draws
+    blue_rect_width, blue_rect_height, red_rect_width, red_rect_height = rng.integers(
+        50, [width // 2, height // 2, width // 2, height // 2], endpoint=True)
+    blue_x, blue_y, red_x, red_y = rng.integers(
+        0, [width - blue_rect_width, height - blue_rect_height, width - red_rect_width, height - red_rect_height], endpoint=True)
 
-def generate_slide(slide_number, width=1920, height=1080, fontname="arial.ttf", font_size=24, file_name="aqua.flv"):
-    # Create a pure white canvas
-    image = Image.new("RGB", (width, height), "white")
-    draw = ImageDraw.Draw(image)
-    
-    # --- Draw the Blue Rectangle ---
-    blue_rect_width = random.randint(50, width // 2)
-    blue_rect_height = random.randint(50, height // 2)
-    blue_x = random.randint(0, width - blue_rect_width)
-    blue_y = random.randint(0, height - blue_rect_height)
-    blue_coords = (blue_x, blue_y, blue_x + blue_rect_width, blue_y + blue_rect_height)
-    draw.rectangle(blue_coords, fill="blue")
-    
-    # --- Draw the Red Rectangle (Always on top) ---
-    red_rect_width = random.randint(50, width // 2)
-    red_rect_height = random.randint(50, height // 2)
-    red_x = random.randint(0, width - red_rect_width)
-    red_y = random.randint(0, height - red_rect_height)
-    red_coords = (red_x, red_y, red_x + red_rect_width, red_y + red_rect_height)
-    draw.rectangle(red_coords, fill="red")
-    
     # --- Add the Slide Text ---
     # The text follows the pattern: "aqua.flv - slide XXXX"
-    text = f"{file_name} - slide {slide_number:04d}"
-    font = ImageFont.load_default()
-
-    # Use textbbox to determine the text's dimensions
-    # VT323 from Google Fonts (https://fonts.google.com/specimen/VT323)
-    font = ImageFont.truetype(fontname, font_size)  # Increase size value
-    bbox = draw.textbbox((0, 0), text, font=font)
-    text_width = bbox[2] - bbox[0]
-    text_height = bbox[3] - bbox[1]
-        
     margin = 10
-    # Placing the text in the bottom-left corner
-    text_position = (margin, height - text_height - margin)
-    draw.text(text_position, text, fill="black", font=font)
+    bbox = label["bbox"]
+    text_height = bbox[3] - bbox[1]
+    text_mask = compose_label(label, slide_number)
+
+    # Reset the shared canvas to pure white and draw both rectangles, placing the text in the bottom-left corner
+    fill_slide(canvas, blue_x, blue_y, blue_rect_width, blue_rect_height, red_x, red_y, red_rect_width, red_rect_height,
+               text_mask, margin, max(height - text_height - margin, 0))
     
-    return image
+    return canvas
 
 
 
 # --- Function to Generate a Tone for Each Slide ---
-def generate_tone(duration, sample_rate, min_freq=300, max_freq=1000):
-    # Summon a tone of random frequency between 300 Hz and 1000 Hz
-    frequency = random.uniform(min_freq, max_freq)
-    t = np.linspace(0, duration, int(sample_rate * duration), endpoint=False)
-    amplitude = 0.5
-    tone = amplitude * np.sin(2 * np.pi * frequency * t)
-    # Create a stereo tone (duplicate the channel)
-    tone_stereo = np.column_stack((tone, tone))
-    return tone_stereo
+@njit(fastmath=True, cache=True)
+def nco(out, phase_inc, amplitude):
+    # Numerically controlled oscillator: a 32-bit phase accumulator advances by phase_inc each sample
+    phase = np.uint32(0)
+    for i in range(out.size):
+        # Round rather than truncate, so the int16 samples are not biased toward zero
+        out[i] = np.floor(amplitude * SINE_LUT[phase >> PHASE_SHIFT] + np.float32(0.5))
+        phase = np.uint32(phase + phase_inc)
+
+def generate_tone_into(out, sample_rate, min_freq=300, max_freq=1000):
+    # Summon a tone of random frequency between 300 Hz and 1000 Hz into a mono int16 buffer
+    frequency = rng.uniform(min_freq, max_freq)
+    phase_inc = np.uint32(round(frequency * 2**32 / sample_rate))
+    amplitude = np.float32(0.5)
+    nco(out, phase_inc, amplitude)
+    return out
 
 def generate_sine_wave():
     """
@@ -84,6 +147,34 @@ def generate_sine_wave():
 
     return frequency, sample_rate, sine_wave
     
+# --- Function to Start the Encoder ---
+def open_encoder(file_name, width, height, fps, slide_duration, audio_path, sample_rate):
+    # Raw rgb24 frames arrive on stdin, one per slide at a rate of 1/slide_duration, and ffmpeg
+    # duplicates them up to the output fps; the tones are read from a raw 16-bit mono PCM file
+    slide_rate = 1 / Fraction(slide_duration).limit_denominator(1000)
+    command = [
+        get_setting("FFMPEG_BINARY"), "-y", "-loglevel", "error",
+        "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{width}x{height}", "-r", str(slide_rate), "-i", "-",
+        "-f", "s16le", "-ar", str(sample_rate), "-ac", "1", "-i", audio_path,
+        # Frames within a slide are identical, so motion search is wasted effort
+        "-c:v", "libx264", "-preset", "ultrafast", "-tune", "stillimage", "-g", str(fps), "-pix_fmt", "yuv420p",
+        # Keep MoviePy's former deliverable: 44.1 kHz stereo AAC, whatever the synthesis rate. The mono
+        # tone is copied to both channels at full level, as ffmpeg's default upmix would attenuate it by 3 dB
+        "-r", str(fps), "-c:a", "aac", "-ar", "44100", "-af", "pan=stereo|c0=c0|c1=c0",
+        file_name,
+    ]
+    return subprocess.Popen(command, stdin=subprocess.PIPE)
+
+def _write_frames(stdin, frame_queue):
+    # Feed queued slides to ffmpeg until the None sentinel arrives; closing stdin is left to the caller
+    try:
+        for frame in iter(frame_queue.get, None):
+            stdin.write(frame)
+    except BrokenPipeError:
+        # ffmpeg has exited; keep draining so the producer never blocks, its exit code reports the failure
+        for _ in iter(frame_queue.get, None):
+            pass
+
 # --- Main Conjuration Routine ---
 def generate_video(width=640, height=360, num_slides=10, slide_duration=1.0, font="arial.ttf", font_size=24, displayed_file_name="aqua.flv", min_freq=400, max_freq=10000, file_name="torso_output.mp4", fps=25):
     """
@@ -130,34 +221,55 @@ def generate_video(width=640, height=360, num_slides=10, slide_duration=1.0, fon
                        font_size=32, displayed_file_name="mystery.avi", min_freq=400, max_freq=1000, 
                        file_name="webdriver_torso.mp4", fps=30)
     """
-    # Initialize lists to store video and audio components 
-    slide_clips = []   # To collect visual clips of each slide
-    audio_segments = []  # To collect corresponding audio tones
-
-    # For each slide, create its visual and auditory essence
-    for i in range(1, num_slides + 1):
-        # Generate and convert slide image into an array for MoviePy
-        pil_image = generate_slide(i, width, height, font, font_size, displayed_file_name)
-        frame = np.array(pil_image)
-        clip = ImageClip(frame).set_duration(slide_duration)
-        slide_clips.append(clip)
-        
-        # Generate the unique tone for this slide
-        tone = generate_tone(slide_duration, SAMPLE_RATE, min_freq, max_freq)
-        audio_segments.append(tone)
-    
-    # Conjure the video by concatenating all slide clips
-    video = concatenate_videoclips(slide_clips, method="compose")
-    
-    # Merge the audio tones into a continuous stream
-    audio_array = np.concatenate(audio_segments, axis=0)
-    audio_clip = AudioArrayClip(audio_array, fps=SAMPLE_RATE)
-    
-    # Bind the audio to the visual sequence
-    video = video.set_audio(audio_clip)
-    
-    # Output the final spectral creation to a file
-    video.write_videofile(file_name, fps=fps, codec="libx264", audio_codec="aac")
+    # A single canvas is reused for every slide
+    canvas = np.empty((height, width, 3), np.uint8)
+
+    # Load the font once rather than re-parsing it for every slide
+    # VT323 from Google Fonts (https://fonts.google.com/specimen/VT323)
+    font_obj = ImageFont.truetype(font, font_size)
+    label = prerender_label(font_obj, displayed_file_name)
+
+    # Initialize the audio stream
+    samples_per_slide = int(slide_duration * SAMPLE_RATE)
+    audio_array = np.empty(num_slides * samples_per_slide, np.int16)  # Continuous stream of tones
+
+    # Generate the unique tone for each slide, written straight into one continuous stream
+    for i in range(num_slides):
+        start = i * samples_per_slide
+        generate_tone_into(audio_array[start:start + samples_per_slide], SAMPLE_RATE, min_freq, max_freq)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # ffmpeg muxes the audio from a file while the frames are piped in
+        audio_path = os.path.join(temp_dir, "audio.raw")
+        audio_array.tofile(audio_path)
+        encoder = open_encoder(file_name, width, height, fps, slide_duration, audio_path, SAMPLE_RATE)
+
+        # A dedicated thread feeds ffmpeg so encoding overlaps with slide generation
+        frame_queue = queue.Queue(maxsize=4)
+        writer = threading.Thread(target=_write_frames, args=(encoder.stdin, frame_queue))
+        writer.start()
+
+        # For each slide, draw it and hand the raw rgb24 frame to the writer
+        try:
+            for i in range(1, num_slides + 1):
+                generate_slide(canvas, i, label)
+                frame_queue.put(canvas.tobytes())
+        except BaseException:
+            # Kill ffmpeg rather than letting it finalize a truncated video
+            encoder.kill()
+            encoder.wait()
+            raise
+        finally:
+            frame_queue.put(None)
+            writer.join()
+
+        # Output the final spectral creation to a file
+        try:
+            encoder.stdin.close()
+        except BrokenPipeError:
+            pass  # ffmpeg has already exited; its exit code reports the failure
+        if encoder.wait() != 0:
+            raise subprocess.CalledProcessError(encoder.returncode, encoder.args)
 
 if __name__ == '__main__':
     generate_video()